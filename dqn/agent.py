@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import warnings
 
 import torch
 import torch.nn.functional as F
@@ -14,7 +15,8 @@ class Agent():
     """Basic experinece replay agent."""
 
     def __init__(self, state_size, action_size, seed, buffer_size=int(1e5), 
-                 batch_size=64, gamma=0.99, tau=1e-3, lr=5e-4, update_every=4, checkpoint_file='checkpoint.pth'):
+                 batch_size=64, gamma=0.99, tau=1e-3, lr=5e-4, update_every=4, checkpoint_file='checkpoint.pth',
+                 buffer_dir=None, grads_per_update=1):
         """Initialize an Agent object.
         
         Params
@@ -28,42 +30,113 @@ class Agent():
             tau:               for soft update of target parameters
             lr:                learning rate 
             update_every:      how often to update the network
+            checkpoint_file:   file to save/load the model
+            buffer_dir:        if set, memory-map the replay buffer into this directory
+            grads_per_update:  minibatches sampled and learned from in one fused step per update
             
         """
         self.state_size = state_size
         self.action_size = action_size
         self.seed = random.seed(seed)
+        self._py_rng = random.Random(seed)
+        self._np_rng = np.random.default_rng(seed)
         self.buffer_size = buffer_size
         self.batch_size = batch_size
         self.gamma = gamma
         self.tau = tau
         self.lr = lr
         self.update_every = update_every
+        self.grads_per_update = grads_per_update
         self.checkpoint_file = checkpoint_file
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        # K minibatches sampled with replacement form one batch of K*batch_size
+        learn_batch_size = batch_size * grads_per_update
         
 
+        # Replay memory
+        self.memory = ReplayBuffer(state_size, action_size, buffer_size, learn_batch_size, seed, self.device,
+                                   memmap_dir=buffer_dir)
+
         # Q-Network
         self.qnetwork_local = QNetwork(state_size, action_size, seed).to(self.device)
         self.qnetwork_target = QNetwork(state_size, action_size, seed).to(self.device)
         self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=lr)
+        # Parameter lists for the fused soft update
+        self._local_params = list(self.qnetwork_local.parameters())
+        self._target_params = list(self.qnetwork_target.parameters())
+        # Preallocated intermediates for the TD target computation
+        self._not_done_buf = torch.empty(learn_batch_size, 1, dtype=torch.float32, device=self.device)
+        self._targets_buf = torch.empty(learn_batch_size, 1, dtype=torch.float32, device=self.device)
+        # Forward passes specialized for the fixed act and learn batch shapes;
+        # traced modules share parameters with qnetwork_local
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)  # trace is deprecated in newer torch
+            self._qnet_act = torch.jit.trace(self.qnetwork_local, torch.zeros(1, state_size, device=self.device))
+            if self.device.type == 'cuda' and hasattr(torch, 'compile'):
+                # Fixed-shape learning step, captured as a CUDA graph. The
+                # target buffers are written in place, so they must be static
+                # inputs or cudagraphs are skipped for the mutation
+                torch._dynamo.mark_static_address(self._not_done_buf)
+                torch._dynamo.mark_static_address(self._targets_buf)
+                # Sampled batches always live in the same tensors; as static
+                # inputs they are not copied into graph placeholders per replay
+                self.memory.mark_static()
+                self._qnet_learn = self.qnetwork_local
+                self._learn_step = torch.compile(self._learn_step, mode="reduce-overhead")
+            else:
+                self._qnet_learn = torch.jit.trace(self.qnetwork_local, torch.zeros(learn_batch_size, state_size, device=self.device))
+
+        # Reusable single-state input buffers for act (pinned host -> device)
+        self._act_cpu = torch.empty(1, state_size, dtype=torch.float32, pin_memory=torch.cuda.is_available())
+        self._act_cpu_np = self._act_cpu.numpy()
+        self._act_gpu = torch.empty(1, state_size, dtype=torch.float32, device=self.device)
+
+        # Side stream for learning; train() queues updates on it before
+        # stepping the env, so simulation overlaps the update
+        self._learn_stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
 
-        # Replay memory
-        self.memory = ReplayBuffer(action_size, buffer_size, batch_size, seed, self.device)
         # Initialize time step (for updating every UPDATE_EVERY steps)
         self.t_step = 0
     
     def step(self, state, action, reward, next_state, done):
         # Save experience in replay memory
         self.memory.add(state, action, reward, next_state, done)
+        self._maybe_learn()
+
+    def step_batch(self, states, actions, rewards, next_states, dones):
+        """Save one experience per parallel agent and learn as in `step`.
         
+        Params
+        ======
+            states (array_like): current states, shape [n_agents, state_size]
+            actions (array_like): actions taken, shape [n_agents]
+            rewards (array_like): rewards received, shape [n_agents]
+            next_states (array_like): next states, shape [n_agents, state_size]
+            dones (array_like): episode finished flags, shape [n_agents]
+        """
+        self.memory.add_batch(states, actions, rewards, next_states, dones)
+        self._maybe_learn()
+
+    def _maybe_learn(self):
         # Learn every UPDATE_EVERY time steps.
         self.t_step = (self.t_step + 1) % self.update_every
         if self.t_step == 0:
             # If enough samples are available in memory, get random subset and learn
             if len(self.memory) > self.batch_size:
-                experiences = self.memory.sample()
-                self.learn(experiences, self.gamma)
+                if self._learn_stream is None:
+                    experiences = self.memory.sample()
+                    self.learn(experiences, self.gamma)
+                else:
+                    # Don't update weights still being read by a queued act
+                    self._learn_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(self._learn_stream):
+                        experiences = self.memory.sample()
+                        self.learn(experiences, self.gamma)
+
+    def _wait_for_learn(self):
+        """Make the current stream wait for any in-flight update of the networks."""
+        if self._learn_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._learn_stream)
 
     def act(self, state, eps=0.):
         """Returns actions for given state as per current policy.
@@ -73,17 +146,39 @@ class Agent():
             state (array_like): current state
             eps (float): epsilon, for epsilon-greedy action selection
         """
-        state = torch.from_numpy(state).float().unsqueeze(0).to(self.device)
-        self.qnetwork_local.eval()
+        # Epsilon-greedy action selection; exploring steps skip the network
+        if self._py_rng.random() <= eps:
+            return self._py_rng.randrange(self.action_size)
+
+        self._wait_for_learn()
+        self._act_cpu_np[0] = state
+        self._act_gpu.copy_(self._act_cpu, non_blocking=True)
+        # QNetwork has no dropout/batchnorm, so it stays in train mode
         with torch.no_grad():
-            action_values = self.qnetwork_local(state)
-        self.qnetwork_local.train()
+            action_values = self._qnet_act(self._act_gpu)
+        return int(action_values.argmax(dim=1).item())
 
-        # Epsilon-greedy action selection
-        if random.random() > eps:
-            return np.argmax(action_values.cpu().data.numpy())
-        else:
-            return random.choice(np.arange(self.action_size))
+    def act_batch(self, states, eps=0.):
+        """Returns actions for a batch of states (one per parallel agent) as per current policy.
+        
+        Params
+        ======
+            states (array_like): current states, shape [n_agents, state_size]
+            eps (float): epsilon, for epsilon-greedy action selection
+        """
+        # Epsilon-greedy action selection; if every agent explores, the
+        # network (and any in-flight update) is not waited on at all
+        n = len(states)
+        explore = self._np_rng.random(n) < eps
+        random_actions = self._np_rng.integers(self.action_size, size=n)
+        if explore.all():
+            return random_actions
+
+        self._wait_for_learn()
+        states = torch.from_numpy(states).float().to(self.device, non_blocking=True)
+        with torch.no_grad():
+            greedy = self.qnetwork_local(states).argmax(dim=1).cpu().numpy()
+        return np.where(explore, random_actions, greedy)
 
     def learn(self, experiences, gamma):
         """Update value parameters using given batch of experience tuples.
@@ -92,37 +187,48 @@ class Agent():
             experiences (Tuple[torch.Tensor]): tuple of (s, a, r, s', done) tuples 
             gamma (float): discount factor
         """
-        states, actions, rewards, next_states, dones = experiences
-
-        # Get max predicted Q values (for next states) from target model
-        Q_targets_next = self.qnetwork_target(next_states).detach().max(1)[0].unsqueeze(1)
-        # Compute Q targets for current states 
-        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
-
-        # Get expected Q values from local model
-        Q_expected = self.qnetwork_local(states).gather(1, actions)
-
         # Compute loss
-        loss = F.mse_loss(Q_expected, Q_targets)
+        loss = self._learn_step(*experiences, gamma)
         # Minimize the loss
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         loss.backward()
         self.optimizer.step()
 
         # ------------------- update target network ------------------- #
-        self.soft_update(self.qnetwork_local, self.qnetwork_target, self.tau)                     
+        self.soft_update(self.tau)                     
+
+    def _learn_step(self, states, actions, rewards, next_states, dones, gamma):
+        """Compute the TD loss for a batch of experiences.
+
+        Every call sees the same batch shapes, so on CUDA this is wrapped with
+        torch.compile in __init__ and replayed as a CUDA graph.
+        """
+        with torch.no_grad():
+            Q_targets_next = self.q_targets_next(next_states)
+            # Compute Q targets for current states 
+            torch.sub(1.0, dones, out=self._not_done_buf)
+            Q_targets = torch.addcmul(rewards, Q_targets_next, self._not_done_buf, value=gamma,
+                                      out=self._targets_buf)
 
-    def soft_update(self, local_model, target_model, tau):
-        """Soft update model parameters.
+        # Get expected Q values from local model
+        Q_expected = self._qnet_learn(states).gather(1, actions)
+
+        return F.smooth_l1_loss(Q_expected, Q_targets)
+
+    def q_targets_next(self, next_states):
+        """Get max predicted Q values (for next states) from target model."""
+        return self.qnetwork_target(next_states).max(1, keepdim=True)[0]
+
+    def soft_update(self, tau):
+        """Soft update target network parameters from the local network.
         θ_target = τ*θ_local + (1 - τ)*θ_target
         Params
         ======
-            local_model (PyTorch model): weights will be copied from
-            target_model (PyTorch model): weights will be copied to
             tau (float): interpolation parameter 
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(tau*local_param.data + (1.0-tau)*target_param.data)
+        with torch.no_grad():
+            torch._foreach_mul_(self._target_params, 1.0 - tau)
+            torch._foreach_add_(self._target_params, self._local_params, alpha=tau)
             
     def train(self, env, n_episodes=2000, max_t=1000, eps_start=1.0, eps_end=0.01, eps_decay=0.995):
         """Train Agent by playing simulator
@@ -138,30 +244,38 @@ class Agent():
         scores = []                        # list containing scores from each episode
         moving_avgs = []                   # list of moving averages
         scores_window = deque(maxlen=100)  # last 100 scores
+        window_sum = 0.0                   # running sum of scores_window
         brain_name = env.brain_names[0]    # get env default branin name
         env_info = env.reset(train_mode=False)[brain_name] # intialize the environment
         eps = eps_start                    # initialize epsilon
         for i_episode in range(1, n_episodes+1):
             env_info = env.reset(train_mode=True)[brain_name]
-            state = env_info.vector_observations[0]   # get the next state
-            score = 0
+            states = env_info.vector_observations     # get the current states (one per agent)
+            score = np.zeros(len(env_info.agents))
             for t in range(max_t):
-                action = self.act(state, eps).astype(int)
-                env_info = env.step(action)[brain_name]
-                next_state = env_info.vector_observations[0]   # get the next state
-                reward = env_info.rewards[0]                   # get the reward
-                done = env_info.local_done[0]                  # see if episode has finished
-                self.step(state, action, reward, next_state, done)
-                state = next_state
-                score += reward
-                if done:
+                actions = self.act_batch(states, eps)
+                # Queue the update before stepping the simulator, so the
+                # update runs while the env computes the next state
+                self._maybe_learn()
+                env_info = env.step(actions)[brain_name]
+                next_states = env_info.vector_observations     # get the next states
+                rewards = np.asarray(env_info.rewards)         # get the rewards
+                dones = np.asarray(env_info.local_done)        # see if episode has finished
+                self.memory.add_batch(states, actions, rewards, next_states, dones)
+                states = next_states
+                score += rewards
+                if np.any(dones):
                     break 
+            score = np.mean(score)            # average score over parallel agents
+            if len(scores_window) == scores_window.maxlen:
+                window_sum -= scores_window[0]  # score about to leave the window
+            window_sum += score
             scores_window.append(score)       # save most recent score
             scores.append(score)              # save most recent score
-            moving_avg = np.mean(scores_window)  # calculate moving average
+            moving_avg = window_sum / len(scores_window)  # calculate moving average
             moving_avgs.append(moving_avg)       # save most recent moving average
             eps = max(eps_end, eps_decay*eps) # decrease epsilon
-            print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, np.mean(scores_window)), end="")
+            print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, moving_avg), end="")
             if i_episode % 100 == 0:
                 print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, moving_avg))
             if moving_avg>= 13.0:
@@ -192,22 +306,38 @@ class Agent():
                 if done:                                       # exit loop if episode finished
                     scores.append(score)
                     avg_scores.append(np.mean(scores))
-                    print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, np.mean(scores)))
+                    print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, avg_scores[-1]))
                     break    
         return scores, avg_scores 
     
     def save(self):
-        """Save the model
+        """Save the model, target network, optimizer state and time step
         Params
         ======
             file: checkpoint file name
         """
-        torch.save(self.qnetwork_local.state_dict(), self.checkpoint_file)
+        self._wait_for_learn()
+        checkpoint = {
+            'local': self.qnetwork_local.state_dict(),
+            'target': self.qnetwork_target.state_dict(),
+            'opt': self.optimizer.state_dict(),
+            't_step': self.t_step,
+        }
+        torch.save(checkpoint, self.checkpoint_file, _use_new_zipfile_serialization=False)
 
     def load(self):
-        """Load the model
+        """Load the model, and the training state if the checkpoint has it
         Params
         ======
             file: checkpoint file name
         """
-        self.qnetwork_local.load_state_dict(torch.load(self.checkpoint_file))
\ No newline at end of file
+        self._wait_for_learn()
+        checkpoint = torch.load(self.checkpoint_file, map_location=self.device)
+        if 'local' not in checkpoint:
+            # Older checkpoints hold only the local network weights
+            self.qnetwork_local.load_state_dict(checkpoint)
+            return
+        self.qnetwork_local.load_state_dict(checkpoint['local'])
+        self.qnetwork_target.load_state_dict(checkpoint['target'])
+        self.optimizer.load_state_dict(checkpoint['opt'])
+        self.t_step = checkpoint['t_step']
@@ -1,35 +1,8 @@
-import torch
-import torch.nn.functional as F
-import torch.optim as optim
 from dqn import Agent
 
 class DoubleAgent(Agent):
 
-    def learn(self, experiences, gamma):
-        """Update value parameters using given batch of experience tuples.
-        Params
-        ======
-            experiences (Tuple[torch.Tensor]): tuple of (s, a, r, s', done) tuples 
-            gamma (float): discount factor
-        """
-        states, actions, rewards, next_states, dones = experiences
-
-        # Get max predicted Q values (for next states) from target model
-        # Q_targets_next = self.qnetwork_target(next_states).detach().max(1)[0].unsqueeze(1)
-        indices = torch.argmax(self.qnetwork_local(next_states).detach(),1)
-        Q_targets_next = self.qnetwork_target(next_states).detach().gather(1,indices.unsqueeze(1))        
-        # Compute Q targets for current states 
-        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
-
-        # Get expected Q values from local model
-        Q_expected = self.qnetwork_local(states).gather(1, actions)
-
-        # Compute loss
-        loss = F.mse_loss(Q_expected, Q_targets)
-        # Minimize the loss
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-
-        # ------------------- update target network ------------------- #
-        self.soft_update(self.qnetwork_local, self.qnetwork_target, self.tau)                     
+    def q_targets_next(self, next_states):
+        """Get Q values (for next states) from target model for the actions selected by local model."""
+        indices = self._qnet_learn(next_states).argmax(1, keepdim=True)
+        return self.qnetwork_target(next_states).gather(1, indices)
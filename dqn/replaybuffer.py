@@ -1,44 +1,156 @@
 import numpy as np
-import random
-from collections import namedtuple, deque
+import os
 import torch
 
 class ReplayBuffer:
     """Fixed-size buffer to store experience tuples."""
 
-    def __init__(self, action_size, buffer_size, batch_size, seed, device):
+    def __init__(self, state_size, action_size, buffer_size, batch_size, seed, device, obs_dtype=np.float16, memmap_dir=None):
         """Initialize a ReplayBuffer object.
         Params
         ======
+            state_size (int): dimension of each state
             action_size (int): dimension of each action
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
             seed (int): random seed
+            obs_dtype (numpy dtype): storage type of observations, upcast to float32 on sample
+            memmap_dir (str): if set, back the buffer with memory-mapped files in this directory
         """
         self.action_size = action_size
-        self.memory = deque(maxlen=buffer_size)  
+        self.buffer_size = buffer_size
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
-        self.seed = random.seed(seed)
+        self._np_rng = np.random.default_rng(seed)
         self.device = device
+        self.memmap_dir = memmap_dir
+        if memmap_dir is not None:
+            os.makedirs(memmap_dir, exist_ok=True)
+
+        # Preallocated ring buffer, one array per experience field. Each
+        # observation is stored once: the next state of the experience in
+        # slot i is the state in slot i + stride, where stride is the number
+        # of agents adding experiences together.
+        self.obs = self._alloc('obs', (buffer_size, state_size), obs_dtype)
+        self.actions = self._alloc('actions', (buffer_size, 1), np.int64)
+        self.rewards = self._alloc('rewards', (buffer_size, 1), np.float32)
+        self.dones = self._alloc('dones', (buffer_size, 1), np.uint8)
+        # Experiences whose next state was overwritten by a different state
+        # (an episode cut off without done); they are never sampled
+        self._lost_next = np.zeros(buffer_size, dtype=bool)
+        self._n_lost = 0
+        self._ptr = 0        # next write position
+        self._size = 0       # number of stored experiences
+        self._stride = None  # number of experiences added per step
+
+        # Persistent batch tensors, refilled in place by sample(): indices are
+        # gathered into a pinned host batch in storage types, then copied
+        # asynchronously (and upcast) into the float32 device batch, whose
+        # addresses stay stable across learning steps
+        pin = device.type == 'cuda'
+        obs_torch_dtype = torch.from_numpy(self.obs[:0]).dtype
+        self._cpu_batch_states = torch.empty(batch_size, state_size, dtype=obs_torch_dtype, pin_memory=pin)
+        self._cpu_batch_actions = torch.empty(batch_size, 1, dtype=torch.long, pin_memory=pin)
+        self._cpu_batch_rewards = torch.empty(batch_size, 1, dtype=torch.float32, pin_memory=pin)
+        self._cpu_batch_next_states = torch.empty(batch_size, state_size, dtype=obs_torch_dtype, pin_memory=pin)
+        self._cpu_batch_dones = torch.empty(batch_size, 1, dtype=torch.uint8, pin_memory=pin)
+        self._gpu_batch_states = torch.empty(batch_size, state_size, dtype=torch.float32, device=device)
+        self._gpu_batch_actions = torch.empty(batch_size, 1, dtype=torch.long, device=device)
+        self._gpu_batch_rewards = torch.empty(batch_size, 1, dtype=torch.float32, device=device)
+        self._gpu_batch_next_states = torch.empty(batch_size, state_size, dtype=torch.float32, device=device)
+        self._gpu_batch_dones = torch.empty(batch_size, 1, dtype=torch.float32, device=device)
+        # Device staging for the fields stored in narrower types: the async
+        # copy lands here unchanged and is then cast into the float32 batch
+        # in place, so the upcast needs no temporary device tensors
+        self._gpu_stage_states = torch.empty(batch_size, state_size, dtype=obs_torch_dtype, device=device)
+        self._gpu_stage_next_states = torch.empty(batch_size, state_size, dtype=obs_torch_dtype, device=device)
+        self._gpu_stage_dones = torch.empty(batch_size, 1, dtype=torch.uint8, device=device)
+        # Signals when the previous async copy has drained the host batch
+        self._copy_done = torch.cuda.Event() if pin else None
     
+    def mark_static(self):
+        """Mark the persistent device batch as static inputs for torch.compile."""
+        for batch in (self._gpu_batch_states, self._gpu_batch_actions, self._gpu_batch_rewards,
+                      self._gpu_batch_next_states, self._gpu_batch_dones):
+            torch._dynamo.mark_static_address(batch)
+
+    def _alloc(self, name, shape, dtype):
+        """Allocate storage for one experience field, in memory or memory-mapped."""
+        if self.memmap_dir is None:
+            return np.empty(shape, dtype=dtype)
+        path = os.path.join(self.memmap_dir, '{}.dat'.format(name))
+        return np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
     def add(self, state, action, reward, next_state, done):
         """Add a new experience to memory."""
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
+        self.add_batch(state[None], [action], [reward], next_state[None], [done])
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add one experience per parallel agent to memory."""
+        n = len(states)
+        if self._stride is None:
+            self._stride = n
+        elif n != self._stride:
+            raise ValueError('expected {} experiences per step, got {}'.format(self._stride, n))
+        idx = (self._ptr + np.arange(n)) % self.buffer_size
+        # The states normally equal the next states written by the previous
+        # step. After a reset they overwrite a terminal next state, which is
+        # masked out of the targets by its done flag; if the previous
+        # experience was not done, its next state is lost and it is excluded.
+        states = np.asarray(states, dtype=self.obs.dtype)
+        self._n_lost -= np.count_nonzero(self._lost_next[idx])
+        self._lost_next[idx] = False
+        if self._size > 0:
+            prev = (idx - n) % self.buffer_size
+            lost = np.any(self.obs[idx] != states, axis=1) & (self.dones[prev, 0] == 0)
+            self._lost_next[prev] = lost
+            self._n_lost += np.count_nonzero(lost)
+        self.obs[idx] = states
+        self.obs[(idx + n) % self.buffer_size] = next_states
+        self.actions[idx, 0] = actions
+        self.rewards[idx, 0] = rewards
+        self.dones[idx, 0] = dones
+        self._ptr = (self._ptr + n) % self.buffer_size
+        self._size = min(self._size + n, self.buffer_size)
     
     def sample(self):
         """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
+        # Count back from the newest experience. The `stride` slots after it
+        # hold the latest next states, so once the ring wraps the oldest
+        # experiences there have lost their states and are skipped.
+        valid = min(self._size, self.buffer_size - self._stride)
+        skipped = (self._ptr - 1 - np.arange(valid, self._size)) % self.buffer_size
+        if self._n_lost - np.count_nonzero(self._lost_next[skipped]) >= valid:
+            raise ValueError('no experiences with a stored next state to sample')
+        idx = (self._ptr - 1 - self._np_rng.integers(0, valid, self.batch_size)) % self.buffer_size
+        # Redraw experiences whose next state was lost
+        lost = self._lost_next[idx]
+        while lost.any():
+            idx[lost] = (self._ptr - 1 - self._np_rng.integers(0, valid, np.count_nonzero(lost))) % self.buffer_size
+            lost = self._lost_next[idx]
+        next_idx = (idx + self._stride) % self.buffer_size
+
+        if self._copy_done is not None:
+            self._copy_done.synchronize()
+        np.take(self.obs, idx, axis=0, out=self._cpu_batch_states.numpy())
+        np.take(self.actions, idx, axis=0, out=self._cpu_batch_actions.numpy())
+        np.take(self.rewards, idx, axis=0, out=self._cpu_batch_rewards.numpy())
+        np.take(self.obs, next_idx, axis=0, out=self._cpu_batch_next_states.numpy())
+        np.take(self.dones, idx, axis=0, out=self._cpu_batch_dones.numpy())
 
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(self.device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(self.device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(self.device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(self.device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(self.device)
+        self._gpu_stage_states.copy_(self._cpu_batch_states, non_blocking=True)
+        self._gpu_batch_actions.copy_(self._cpu_batch_actions, non_blocking=True)
+        self._gpu_batch_rewards.copy_(self._cpu_batch_rewards, non_blocking=True)
+        self._gpu_stage_next_states.copy_(self._cpu_batch_next_states, non_blocking=True)
+        self._gpu_stage_dones.copy_(self._cpu_batch_dones, non_blocking=True)
+        self._gpu_batch_states.copy_(self._gpu_stage_states)
+        self._gpu_batch_next_states.copy_(self._gpu_stage_next_states)
+        self._gpu_batch_dones.copy_(self._gpu_stage_dones)
+        if self._copy_done is not None:
+            self._copy_done.record()
   
-        return (states, actions, rewards, next_states, dones)
+        return (self._gpu_batch_states, self._gpu_batch_actions, self._gpu_batch_rewards,
+                self._gpu_batch_next_states, self._gpu_batch_dones)
 
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
+        return self._size